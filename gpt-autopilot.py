@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import traceback
+import asyncio
 import openai
 import shutil
 import random
@@ -17,6 +18,7 @@ from modules import prompt_selector
 from modules import gpt_functions
 from modules import betterprompter
 from modules import filesystem
+from modules import fastjson
 from modules import checklist
 from modules import cmd_args
 from modules import chatgpt
@@ -27,36 +29,44 @@ from modules import git
 CONFIG = get_config()
 
 def compact_commands(messages):
-    for msg in messages:
-        if msg["role"] == "function" and msg["name"] == "file_open_for_writing":
-            msg["content"] = "Respond with file content. Put file content between lines START_OF_FILE_CONTENT and END_OF_FILE_CONTENT"
+    content = "Respond with file content. Put file content between lines START_OF_FILE_CONTENT and END_OF_FILE_CONTENT"
+    for i, msg in enumerate(messages):
+        if msg["role"] == "function" and msg["name"] == "file_open_for_writing" and msg["content"] != content:
+            chatgpt.replace_content(messages, i, content)
     return messages
 
 def remove_hallucinations(messages):
-    for msg in messages:
+    for i, msg in enumerate(messages):
         if msg["role"] == "function" and msg["name"] == "file_open_for_writing":
             try:
                 args = json.loads(msg["function_call"]["arguments"])
                 if "content" in args:
                     args.pop("content")
-                    msg["function_call"]["arguments"] = json.dumps(args)
+                    chatgpt.replace_function_call(messages, i, arguments=json.dumps(args))
             except:
                 continue
     return messages
 
+# compiled comment patterns for each tag
+comment_patterns = {}
+
 def unwrap_comments(content, tags):
     for tag in tags:
-        # Remove HTML-style comments
-        content = re.sub(r"<!--([\s]+)?"+tag+r"([\s]+)?-->", tag, content, flags=re.DOTALL)
-
-        # Remove C-style comments
-        content = re.sub(r"/\*([\s]+)?"+tag+r"([\s]+)?\*/", tag, content, flags=re.DOTALL)
-
-        # Remove PHP-style comments
-        content = re.sub(r"//([\s]+)?"+tag+r"([\s]+)?$", tag, content, flags=re.MULTILINE)
-
-        # Remove Python-style comments
-        content = re.sub(r"#([\s]+)?"+tag+r"$", tag, content, flags=re.MULTILINE)
+        if tag not in comment_patterns:
+            comment_patterns[tag] = [
+                # HTML-style comments
+                re.compile(r"<!--([\s]+)?"+tag+r"([\s]+)?-->", flags=re.DOTALL),
+                # C-style comments
+                re.compile(r"/\*([\s]+)?"+tag+r"([\s]+)?\*/", flags=re.DOTALL),
+                # PHP-style comments
+                re.compile(r"//([\s]+)?"+tag+r"([\s]+)?$", flags=re.MULTILINE),
+                # Python-style comments
+                re.compile(r"#([\s]+)?"+tag+r"$", flags=re.MULTILINE),
+            ]
+
+        # apply in the same order, as nested comments depend on it
+        for pattern in comment_patterns[tag]:
+            content = pattern.sub(tag, content)
     return content
 
 def strip_markdown(content):
@@ -213,7 +223,9 @@ def parse_filename(arguments):
     match = re.search(filename_pattern, arguments)
     return match.group(1)
 
-def fix_json_arguments(function_name, arguments_plain, message):
+def fix_json_arguments(function_name, arguments_plain, messages):
+    message = messages[-1]
+
     if function_name == "write_file":
         print("ERROR:    Switching to file_open_for_writing")
         function_name = "file_open_for_writing"
@@ -232,8 +244,12 @@ def fix_json_arguments(function_name, arguments_plain, message):
     arguments = {
         "filename": parse_filename(arguments_plain)
     }
-    message["function_call"]["name"] = function_name
-    message["function_call"]["arguments"] = json.dumps(arguments)
+    message = chatgpt.replace_function_call(
+        messages,
+        -1,
+        name=function_name,
+        arguments=json.dumps(arguments),
+    )
 
     return (
         function_name,
@@ -295,7 +311,7 @@ def run_conversation(prompt, model = "gpt-3.5-turbo-16k-0613", messages = [], co
         user_message = messages.pop()
 
     # save message history
-    chatgpt.save_message_history(conv_id, messages)
+    chatgpt.save_message_history(conv_id, messages, snapshot=True)
 
     # add user prompt to chatgpt messages
     try:
@@ -325,7 +341,9 @@ def run_conversation(prompt, model = "gpt-3.5-turbo-16k-0613", messages = [], co
         function_message = None
         if message.get("function_call"):
             # sometimes ChatGPT hallucinates dots in function name
-            message["function_call"]["name"] = re.sub(r'\W+', '', message["function_call"]["name"])
+            fixed_name = re.sub(r'\W+', '', message["function_call"]["name"])
+            if fixed_name != message["function_call"]["name"]:
+                message = chatgpt.replace_function_call(messages, -1, name=fixed_name)
 
             # get function name and arguments
             function_name = message["function_call"]["name"]
@@ -343,7 +361,7 @@ def run_conversation(prompt, model = "gpt-3.5-turbo-16k-0613", messages = [], co
             else:
                 try:
                     # try to parse arguments
-                    arguments = json.loads(arguments_plain)
+                    arguments = fastjson.loads(arguments_plain)
 
                 # if parsing fails, switch file operation functions
                 except:
@@ -351,7 +369,7 @@ def run_conversation(prompt, model = "gpt-3.5-turbo-16k-0613", messages = [], co
                         function_name, function_response, message, arguments = fix_json_arguments(
                             function_name,
                             arguments_plain,
-                            message
+                            messages
                         )
                     except:
                         print("ERROR:    Failed to fix arguments: " + str(e))
@@ -428,7 +446,7 @@ def run_conversation(prompt, model = "gpt-3.5-turbo-16k-0613", messages = [], co
                         messages.append(commit)
 
                     # save message history
-                    chatgpt.save_message_history(conv_id, messages)
+                    chatgpt.save_message_history(conv_id, messages, snapshot=True)
 
                 if recursive == False:
                     checklist.activate_checklist()
@@ -473,7 +491,7 @@ def run_conversation(prompt, model = "gpt-3.5-turbo-16k-0613", messages = [], co
                                 last_prompt, messages = git.revert(messages)
                                 print()
                                 # save message history
-                                chatgpt.save_message_history(conv_id, messages)
+                                chatgpt.save_message_history(conv_id, messages, snapshot=True)
 
                                 if prompt == "retry":
                                     prompt = last_prompt
@@ -620,19 +638,23 @@ def run_conversation(prompt, model = "gpt-3.5-turbo-16k-0613", messages = [], co
         # save last response for the while loop
         message = messages[-1]
 
-def make_prompt_better(prompt, orig_prompt=None, ask=True, temp = 1.0, messages = []):
+def make_prompt_better(prompt, orig_prompt=None, ask=True, temp = 1.0, messages = [], better = None):
     print("\nMaking prompt better...")
 
     if orig_prompt is None:
         orig_prompt = prompt
 
     try:
-        better_prompt, messages = betterprompter.make_better(
-            prompt=prompt,
-            model=CONFIG["model"],
-            temp=temp,
-            messages=messages
-        )
+        # use concurrently fetched better prompt if available
+        if better is not None:
+            better_prompt, messages = better
+        else:
+            better_prompt, messages = betterprompter.make_better(
+                prompt=prompt,
+                model=CONFIG["model"],
+                temp=temp,
+                messages=messages
+            )
     except SystemExit:
         raise
     except Exception as e:
@@ -675,11 +697,13 @@ def load_message_history(arguments):
     if "conv" in arguments:
         history_file = arguments["conv"]
         try:
-            with open(f"history/{history_file}.json", "r") as f:
-                messages = json.load(f)
-            print(f"INFO:     Loaded message history from {history_file}.json")
-        except:
-            print(f"ERROR:    History file {history_file}.json not found")
+            messages = chatgpt.load_message_history(history_file)
+            print(f"INFO:     Loaded message history from {history_file}")
+        except FileNotFoundError:
+            print(f"ERROR:    History file {history_file} not found")
+            sys.exit(1)
+        except Exception as e:
+            print(f"ERROR:    Unable to load history file {history_file}: {e}")
             sys.exit(1)
     else:
         messages = []
@@ -735,12 +759,18 @@ def create_directories():
         if not os.path.isdir(directory):
             os.mkdir(directory)
 
+def get_routing_model():
+    # use a cheaper model for detecting the system message
+    if "routing_model" in CONFIG:
+        return CONFIG["routing_model"]
+    return "gpt-4o-mini"
+
 def get_temp(arguments):
     if "temp" in arguments:
         return arguments["temp"]
     return 1.0
 
-def maybe_make_prompt_better(prompt, args, version_loop = False):
+def maybe_make_prompt_better(prompt, args, version_loop = False, better = None):
     if version_loop == True and "better-versions" not in args:
         return prompt
     if "not-better" not in args:
@@ -748,11 +778,38 @@ def maybe_make_prompt_better(prompt, args, version_loop = False):
             ask = "better" not in args or "ask-better" in args
             prompt = make_prompt_better(
                 prompt=prompt,
-                ask=ask
+                ask=ask,
+                better=better,
             )
         print()
     return prompt
 
+def prefetch_prompt_data(prompt, args, temp):
+    detect = "system" not in args and "use-system" in args
+    better = "better" in args and "not-better" not in args
+
+    # only prefetch when both requests are made without asking the user
+    if not detect or not better:
+        return (None, None)
+
+    async def fetch():
+        return await asyncio.gather(
+            prompt_selector.adetect_slug(prompt, get_routing_model(), temp),
+            # same default temperature as make_prompt_better
+            betterprompter.amake_better(prompt, CONFIG["model"], messages=[]),
+            return_exceptions=True,
+        )
+
+    detected, better_prompt = asyncio.run(fetch())
+
+    # a failed detection is passed on as is, so that detect_slug
+    # goes straight to the main model instead of retrying it.
+    # a failed better prompt is requested again sequentially
+    if isinstance(better_prompt, Exception):
+        better_prompt = None
+
+    return (detected, better_prompt)
+
 def run_versions(prompt, args, version_messages, temp, prev_version = 1):
     version_id = numberfile(paths.relative("versions"), folder=True)
 
@@ -778,6 +835,7 @@ def run_versions(prompt, args, version_messages, temp, prev_version = 1):
     orig_messages = version_messages[prev_version]
 
     extra_prompt = ""
+    better = None
 
     # reset tasklist for every version iteration
     gpt_functions.tasklist = []
@@ -786,7 +844,16 @@ def run_versions(prompt, args, version_messages, temp, prev_version = 1):
 
     # add system message on the first round
     if orig_messages == []:
-        system_message = prompt_selector.select_system_message(prompt, CONFIG["model"], temp)
+        # detect system message and make prompt better concurrently
+        detected, better = prefetch_prompt_data(prompt, args, temp)
+
+        system_message = prompt_selector.select_system_message(
+            prompt=prompt,
+            model=get_routing_model(),
+            temp=temp,
+            detected=detected,
+            fallback_model=CONFIG["model"],
+        )
 
         # add system message
         orig_messages.append({
@@ -817,7 +884,8 @@ def run_versions(prompt, args, version_messages, temp, prev_version = 1):
 
         # MAKE PROMPT BETTER
         version_loop = version > 1
-        prompt = maybe_make_prompt_better(prompt, cmd_args.args, version_loop)
+        prompt = maybe_make_prompt_better(prompt, cmd_args.args, version_loop, better)
+        better = None
 
         # add extra data to prompt
         final_prompt = prompt + extra_prompt
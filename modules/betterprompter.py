@@ -1,55 +1,98 @@
+from openai import api_requestor
+import asyncio
 import openai
-import json
+import time
+import io
 
+from modules import fastjson
 from modules import tokens
 
-def make_better(prompt, model, temp = 1.0, messages = []):
-    if len(prompt.split(" ")) < 80:
+# static system message, kept identical across requests for prompt caching
+BETTER_SYSTEM_MESSAGE = "You are a prompt designer for an AI agent that can read and write files from the filesystem and run commands on the computer. The AI agent is used to create all kinds of projects, including programming and content creaton. Please note that the agent can not run GUI applications or run tests. Only describe the project, not how it should be implemented. The prompt will be given to the AI agent as a description of the project to accomplish."
+
+give_prompt_call = {
+    "name": "give_prompt",
+    "arguments": "prompt"
+}
+
+give_prompt_func = {
+    "name": "give_prompt",
+    "description": "Give the user the better version of the prompt, in full, including modifications",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "prompt": {
+                "type": "string",
+                "description": "Better version of the prompt, in full, including modifications. Can include newlines.",
+            },
+        },
+        "required": ["prompt"],
+    }
+}
+
+give_prompts_call = {
+    "name": "give_prompts",
+    "arguments": "prompts"
+}
+
+give_prompts_func = {
+    "name": "give_prompts",
+    "description": "Give the user the better versions of the prompts, in full, in the same order as given",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "prompts": {
+                "type": "array",
+                "description": "Better versions of the prompts, in full, in the same order as given. Can include newlines.",
+                "items": {
+                    "type": "string"
+                }
+            },
+        },
+        "required": ["prompts"],
+    }
+}
+
+BETTER_USER_MESSAGE = "Convert this prompt into {words} detailed prompt:\n{prompt}"
+MODIFY_USER_MESSAGE = "Please make the following changes to the prompt: {prompt}\n\nRespond with the complete, modified version of the prompt."
+BATCH_USER_MESSAGE = "Convert each of the following prompts into a more detailed prompt. Convert prompts shorter than 80 words into an 80 word detailed prompt. Return the prompts in the same order.\n\n{prompts}"
+
+def initial_messages(prompt):
+    # same as len(prompt.split(" ")) < 80 without building the list
+    if prompt.count(" ") < 79:
         words = "an 80 word"
     else:
         words = "a more"
 
+    return [
+        {
+            "role": "system",
+            "content": BETTER_SYSTEM_MESSAGE
+        },
+        {
+            "role": "user",
+            "content": BETTER_USER_MESSAGE.format(words=words, prompt=prompt)
+        }
+    ]
+
+def make_better(prompt, model, temp = 1.0, messages = []):
+    return asyncio.run(amake_better(prompt, model, temp, messages))
+
+async def amake_better(prompt, model, temp = 1.0, messages = []):
     if messages == []:
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a prompt designer for an AI agent that can read and write files from the filesystem and run commands on the computer. The AI agent is used to create all kinds of projects, including programming and content creaton. Please note that the agent can not run GUI applications or run tests. Only describe the project, not how it should be implemented. The prompt will be given to the AI agent as a description of the project to accomplish."
-            },
-            {
-                "role": "user",
-                "content": "Convert this prompt into "+ words +" detailed prompt:\n" + prompt
-            }
-        ]
+        messages = initial_messages(prompt)
     else:
         messages.append({
             "role": "user",
-            "content": "Please make the following changes to the prompt: " + prompt + "\n\nRespond with the complete, modified version of the prompt."
+            "content": MODIFY_USER_MESSAGE.format(prompt=prompt)
         })
 
-    response = openai.ChatCompletion.create(
+    response = await openai.ChatCompletion.acreate(
         model=model,
         messages=messages,
         temperature=temp,
-        function_call={
-            "name": "give_prompt",
-            "arguments": "prompt"
-        },
-        functions=[
-            {
-                "name": "give_prompt",
-                "description": "Give the user the better version of the prompt, in full, including modifications",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "prompt": {
-                            "type": "string",
-                            "description": "Better version of the prompt, in full, including modifications. Can include newlines.",
-                        },
-                    },
-                    "required": ["prompt"],
-                }
-            }
-        ],
+        function_call=give_prompt_call,
+        functions=[give_prompt_func],
         request_timeout=60,
     )
 
@@ -58,6 +101,167 @@ def make_better(prompt, model, temp = 1.0, messages = []):
     message = response["choices"][0]["message"] # type: ignore
     messages.append(message)
 
-    args = json.loads(message["function_call"]["arguments"]) # type: ignore
+    args = fastjson.loads(message["function_call"]["arguments"]) # type: ignore
 
     return (args["prompt"], messages)
+
+# not used by gpt-autopilot itself, for improving
+# many prompts at once from other scripts
+def make_better_batch(prompts, model, temp = 1.0, batch_api = False):
+    # the batch api is half price but can take up to 24 hours
+    if batch_api:
+        try:
+            return make_better_batch_wait(prompts, model, temp)
+        except SystemExit:
+            raise
+        except Exception as e:
+            print("ERROR:    Batch API request failed, making prompts better directly: " + str(e))
+
+    # improve multiple prompts with a single request
+    messages = [
+        {
+            "role": "system",
+            "content": BETTER_SYSTEM_MESSAGE
+        },
+        {
+            "role": "user",
+            "content": BATCH_USER_MESSAGE.format(prompts=fastjson.dumps(prompts))
+        }
+    ]
+
+    response = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        temperature=temp,
+        function_call=give_prompts_call,
+        functions=[give_prompts_func],
+        request_timeout=60 * len(prompts),
+    )
+
+    tokens.add(response, model)
+
+    message = response["choices"][0]["message"] # type: ignore
+    args = fastjson.loads(message["function_call"]["arguments"]) # type: ignore
+
+    # fall back to one request per prompt if counts don't match
+    if len(args["prompts"]) != len(prompts):
+        print("ERROR:    Batch response doesn't match prompts, making prompts better one by one")
+        return [make_better(prompt, model, temp, [])[0] for prompt in prompts]
+
+    return args["prompts"]
+
+def make_better_batch_submit(prompts, model, temp = 1.0):
+    # one request per line, identical to the ones sent by make_better
+    requests = ""
+    for i, prompt in enumerate(prompts):
+        requests += fastjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": initial_messages(prompt),
+                "temperature": temp,
+                "function_call": give_prompt_call,
+                "functions": [give_prompt_func],
+            }
+        }) + "\n"
+
+    batch_file = openai.File.create(
+        file=io.BytesIO(requests.encode("utf-8")),
+        purpose="batch",
+        user_provided_filename="better_prompts.jsonl",
+    )
+
+    # the pinned openai package has no batch resource
+    response, _, _ = api_requestor.APIRequestor().request("post", "/batches", params={
+        "input_file_id": batch_file["id"], # type: ignore
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h",
+    })
+
+    return response.data["id"] # type: ignore
+
+def make_better_batch_poll(batch_id, model):
+    response, _, _ = api_requestor.APIRequestor().request("get", f"/batches/{batch_id}")
+    batch = response.data # type: ignore
+
+    if batch["status"] == "failed":
+        raise Exception(f"Batch {batch_id} failed")
+
+    # expired and cancelled batches may have partial output
+    if batch["status"] not in ["completed", "expired", "cancelled"]:
+        return None
+
+    results = {}
+
+    # all requests of the batch may have failed
+    if batch.get("output_file_id") is None:
+        return results
+
+    output = openai.File.download(batch["output_file_id"]).decode("utf-8")
+
+    for line in output.splitlines():
+        if line.strip() == "":
+            continue
+
+        result = fastjson.loads(line)
+        response = result.get("response")
+
+        # skip failed requests
+        if result.get("error") or response is None or response.get("status_code") != 200:
+            continue
+
+        body = response["body"]
+
+        # batch requests are billed at half price
+        tokens.add(body, model, price_factor=0.5)
+
+        try:
+            message = body["choices"][0]["message"]
+            args = fastjson.loads(message["function_call"]["arguments"])
+            results[int(result["custom_id"])] = args["prompt"]
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
+
+    # results are keyed by request index, as they are not returned in order
+    return results
+
+def make_better_batch_cancel(batch_id):
+    api_requestor.APIRequestor().request("post", f"/batches/{batch_id}/cancel")
+
+# wait for the whole completion window by default
+def make_better_batch_wait(prompts, model, temp = 1.0, interval = 30, timeout = 24 * 60 * 60, cancel_timeout = 15 * 60):
+    batch_id = make_better_batch_submit(prompts, model, temp)
+
+    print(f"GPT-API:  Waiting for batch {batch_id}... ", end="", flush=True)
+
+    waited = 0
+    cancelled = False
+    results = make_better_batch_poll(batch_id, model)
+    while results is None:
+        # cancel the batch and keep polling for its partial output
+        if not cancelled and waited >= timeout:
+            print("TIMEOUT!")
+            print(f"GPT-API:  Cancelling batch {batch_id}... ", end="", flush=True)
+            make_better_batch_cancel(batch_id)
+            cancelled = True
+            waited = 0
+
+        if cancelled and waited >= cancel_timeout:
+            raise Exception(f"Batch {batch_id} was not cancelled in {cancel_timeout} seconds")
+
+        time.sleep(interval)
+        waited += interval
+        results = make_better_batch_poll(batch_id, model)
+
+    print("OK!")
+
+    # make failed requests better one by one
+    if len(results) != len(prompts):
+        print(f"NOTICE:   {len(prompts) - len(results)} of {len(prompts)} batch requests missing, making them better one by one")
+        for i, prompt in enumerate(prompts):
+            if i not in results:
+                results[i] = make_better(prompt, model, temp, [])[0]
+
+    return [results[i] for i in range(len(prompts))]
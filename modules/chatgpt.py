@@ -1,13 +1,18 @@
+import threading
+import functools
+import requests
+import atexit
 import openai
-import copy
+import random
+import queue
 import time
-import json
 import sys
 import os
 
 from modules.token_saver import save_tokens
 from modules.helpers import yesno
 from modules import gpt_functions
+from modules import fastjson
 from modules import checklist
 from modules import cmd_args
 from modules import tokens
@@ -15,22 +20,69 @@ from modules import paths
 
 create_outline = False
 
-def redact_always(messages):
-    messages_redact = copy.deepcopy(messages)
-    for msg in messages_redact:
-        if msg["role"] == "user" and "APPEND_OK" in msg["content"]:
-            msg["content"] = "File appended succesfully"
+# errors that are worth retrying the request for
+retryable_errors = (
+    openai.error.RateLimitError, # type: ignore
+    openai.error.Timeout, # type: ignore
+    openai.error.APIConnectionError, # type: ignore
+    openai.error.ServiceUnavailableError, # type: ignore
+    openai.error.APIError, # type: ignore
+    openai.error.TryAgain, # type: ignore
+    # errors while reading a streamed response are not wrapped by openai
+    requests.exceptions.RequestException,
+)
+
+# messages already written to the history log of each conversation
+persisted_messages = {}
+
+# flags for message content that needs to be handled
+FLAG_APPEND_OK = 1
+FLAG_NO_END_OF_FILE = 2
+
+def get_flags(message):
+    flags = 0
+
+    # check message content only once when it is added
+    if isinstance(message["content"], str):
+        if message["role"] == "user" and "APPEND_OK" in message["content"]:
+            flags |= FLAG_APPEND_OK
+        if "No END_OF_FILE_CONTENT" in message["content"]:
+            flags |= FLAG_NO_END_OF_FILE
+
+    return flags
+
+def redact_always(messages, message, flags):
+    if not flags & FLAG_APPEND_OK:
+        return messages
+
+    # copy only the list and the rewritten message
+    messages_redact = list(messages)
+    for i in range(len(messages_redact) - 1, -1, -1):
+        if messages_redact[i] is message:
+            messages_redact[i] = {**message, "content": "File appended succesfully"}
             break
     return messages_redact
 
+def replace_content(messages, index, content):
+    # replace the message instead of mutating it so that
+    # other references and the history log see the change
+    messages[index] = {**messages[index], "content": content}
+
+def replace_function_call(messages, index, **changes):
+    # copy the nested function call as well, for the same reason
+    message = messages[index]
+    messages[index] = {**message, "function_call": {**message["function_call"], **changes}}
+    return messages[index]
+
 def redact_messages(messages):
-    messages_redact = copy.deepcopy(messages)
-    for msg in messages_redact:
+    # copy only the list and the rewritten message
+    messages_redact = list(messages)
+    for i, msg in enumerate(messages_redact):
         if msg["role"] == "assistant" and msg["content"] not in [None, "<message redacted>"]:
-            msg["content"] = "<message redacted>"
+            messages_redact[i] = {**msg, "content": "<message redacted>"}
             break
         if msg["role"] == "function" and msg["name"] == "read_file" and msg["content"] not in [None, "<file contents redacted>"]:
-            msg["content"] = "<file contents redacted>"
+            messages_redact[i] = {**msg, "content": "<file contents redacted>"}
             break
     return messages_redact
 
@@ -43,11 +95,171 @@ def filter_messages(messages):
 
     return filtered
 
-def save_message_history(conv_id, messages):
-    if conv_id is not None:
+def history_writer():
+    while True:
+        path, mode, data = history_queue.get()
+        try:
+            if mode == "a":
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(data)
+            else:
+                # replace file atomically
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"ERROR:    Unable to save message history: {e}")
+        finally:
+            history_queue.task_done()
+
+# write message history in the background and
+# wait for pending writes before exiting
+history_queue = queue.Queue()
+threading.Thread(target=history_writer, daemon=True).start()
+atexit.register(history_queue.join)
+
+def save_message_history(conv_id, messages, snapshot = False):
+    if conv_id is None:
+        return
+
+    log_file = paths.relative("history", f"{conv_id}.jsonl")
+    persisted = persisted_messages.get(conv_id)
+
+    # rewrite the whole log if earlier messages have changed
+    rewrite = snapshot or persisted is None or len(messages) < len(persisted) or \
+        any(old is not new for old, new in zip(persisted, messages))
+
+    if rewrite:
+        history_queue.put((log_file, "w", "".join(fastjson.dumps(message) + "\n" for message in messages)))
+    else:
+        # only append new messages to the log
+        history_queue.put((log_file, "a", "".join(fastjson.dumps(message) + "\n" for message in messages[len(persisted):])))
+
+    persisted_messages[conv_id] = list(messages)
+
+    if snapshot:
         history_file = paths.relative("history", f"{conv_id}.json")
-        with open(history_file, "w") as f:
-            f.write(json.dumps(messages, indent=4))
+        history_queue.put((history_file, "w", fastjson.dumps(messages)))
+
+def load_message_history(conv_id):
+    # make sure pending writes are finished
+    history_queue.join()
+
+    log_file = paths.relative("history", f"{conv_id}.jsonl")
+    history_file = paths.relative("history", f"{conv_id}.json")
+
+    # fall back to snapshot for histories without a log
+    if not os.path.exists(log_file):
+        with open(history_file, encoding="utf-8") as f:
+            return fastjson.loads(f.read())
+
+    with open(log_file, encoding="utf-8") as f:
+        lines = [line for line in f if line.strip() != ""]
+
+    messages = []
+    for i, line in enumerate(lines):
+        try:
+            messages.append(fastjson.loads(line))
+        except ValueError:
+            # last line may be cut off by an interrupted write
+            if i == len(lines) - 1:
+                print(f"NOTICE:   Ignoring incomplete last line in {log_file}")
+                break
+
+            # fall back to snapshot if the log is corrupted
+            if os.path.exists(history_file):
+                print(f"NOTICE:   Unable to parse {log_file}, loading {history_file} instead")
+                with open(history_file, encoding="utf-8") as f:
+                    return fastjson.loads(f.read())
+            raise
+
+    return messages
+
+def read_stream(response, print_message):
+    content = ""
+    function_call = None
+    usage = None
+    printed = False
+
+    for chunk in response:
+        # final chunk only contains token usage
+        if chunk.get("usage"):
+            usage = chunk["usage"]
+
+        if not chunk.get("choices"):
+            continue
+
+        delta = chunk["choices"][0].get("delta", {})
+
+        if delta.get("content"):
+            content += delta["content"]
+
+            # print content as it arrives
+            if print_message:
+                if not printed:
+                    print("\n\n## ChatGPT Responded ##\n```\n")
+                    printed = True
+                print(delta["content"], end="", flush=True)
+
+        if delta.get("function_call"):
+            if function_call is None:
+                function_call = {
+                    "name": "",
+                    "arguments": "",
+                }
+            function_call["name"] += delta["function_call"].get("name") or ""
+            function_call["arguments"] += delta["function_call"].get("arguments") or ""
+
+    if printed:
+        print("\n\n```\n")
+
+    message = {
+        "role": "assistant",
+        "content": content,
+    }
+
+    if function_call is not None:
+        message["function_call"] = function_call
+        if content == "":
+            message["content"] = None
+
+    if usage is None:
+        usage = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        }
+
+    return {
+        "choices": [
+            {
+                "message": message
+            }
+        ],
+        "usage": usage,
+    }, printed
+
+# filtered definitions only depend on the state given as arguments
+@functools.lru_cache(maxsize=16)
+def get_filtered_definitions(model, tasklist_skipped, has_active_list, task_operation_performed):
+    definitions = gpt_functions.get_cached_definitions(model, tasklist_skipped)
+
+    if has_active_list:
+        remove_funcs = [
+            "make_tasklist", # don't take any more task lists if there is one already
+            "project_finished" # don't allow project_finished function when task list is unfinished
+        ]
+
+        definitions = [definition for definition in definitions if definition["name"] not in remove_funcs]
+    else:
+        # remove task_finished function if there is no task currently
+        definitions = [definition for definition in definitions if definition["name"] != "task_finished"]
+
+    if task_operation_performed == False:
+        # remove task_finished until an operation is performed
+        definitions = [definition for definition in definitions if definition["name"] != "task_finished"]
+
+    return tuple(definitions)
 
 # ChatGPT API Function
 
@@ -65,29 +277,20 @@ def send_message(
 
     # add user message to message list
     messages.append(message)
+    flags = get_flags(message)
 
     # redact old messages when encountering partial output
-    if "No END_OF_FILE_CONTENT" in message["content"]:
+    if flags & FLAG_NO_END_OF_FILE:
         print("NOTICE:   Partial output detected, redacting messages...")
-        messages[-2]["content"] = "<file content redacted>"
+        replace_content(messages, -2, "<file content redacted>")
         messages = redact_messages(messages)
 
-    definitions = copy.deepcopy(gpt_functions.get_definitions(model))
-
-    if gpt_functions.active_tasklist != [] or checklist.active_list != []:
-        remove_funcs = [
-            "make_tasklist", # don't take any more task lists if there is one already
-            "project_finished" # don't allow project_finished function when task list is unfinished
-        ]
-
-        definitions = [definition for definition in definitions if definition["name"] not in remove_funcs]
-    else:
-        # remove task_finished function if there is no task currently
-        definitions = [definition for definition in definitions if definition["name"] != "task_finished"]
-
-    if gpt_functions.task_operation_performed == False:
-        # remove task_finished until an operation is performed
-        definitions = [definition for definition in definitions if definition["name"] != "task_finished"]
+    definitions = list(get_filtered_definitions(
+        model,
+        gpt_functions.tasklist_skipped,
+        gpt_functions.active_tasklist != [] or checklist.active_list != [],
+        gpt_functions.task_operation_performed,
+    ))
 
     # always ask clarifying questions first
     if "no-questions" not in cmd_args.args and gpt_functions.clarification_asked < gpt_functions.initial_question_count:
@@ -127,9 +330,6 @@ For a trivial project, make just one task"""
 
     print("GPT-API:  Waiting... ", end="", flush=True)
 
-    # save message history
-    save_message_history(conv_id, messages)
-
     try:
         # send prompt to chatgpt
         response = openai.ChatCompletion.create(
@@ -139,8 +339,18 @@ For a trivial project, make just one task"""
             function_call=function_call,
             temperature=temp,
             request_timeout=120,
+            stream=True,
+            stream_options={
+                "include_usage": True
+            },
         )
 
+        # collect streamed response
+        response, printed = read_stream(response, print_message)
+
+        if printed:
+            print("GPT-API:  ", end="")
+
         tokens.add(response, model)
         request_tokens = response["usage"]["total_tokens"] # type: ignore
         total_tokens = int(tokens.token_usage["total"])
@@ -176,13 +386,7 @@ For a trivial project, make just one task"""
             print_message=print_message,
             temp=temp,
         )
-    except openai.error.PermissionError: # type: ignore
-        raise
-    except TypeError:
-        raise
-    except NameError:
-        raise
-    except Exception as e:
+    except retryable_errors as e:
         if retries >= 4:
             raise
 
@@ -190,16 +394,14 @@ For a trivial project, make just one task"""
             if yesno("\n\nERROR:    You have exceeded your OpenAI API quota. Would you like to try again?") == "n":
                 sys.exit(1)
 
-        # if request fails, wait 5 seconds and try again
-        print("\nERROR:    OpenAI request failed... Trying again")
-        time.sleep(5)
+        # if request fails, wait with exponential backoff and try again
+        delay = min(60, 2 ** retries + random.random())
+        print(f"\nERROR:    OpenAI request failed... Trying again in {round(delay)} seconds")
+        time.sleep(delay)
 
         # remove last message
         messages.pop()
 
-        # save message history
-        save_message_history(conv_id, messages)
-
         return send_message(
             message=message,
             messages=messages,
@@ -212,7 +414,7 @@ For a trivial project, make just one task"""
         )
 
     # redact long responses that don't need to be in history
-    messages = redact_always(messages)
+    messages = redact_always(messages, message, flags)
 
     # add response to message list
     messages.append(response["choices"][0]["message"]) # type: ignore
@@ -220,13 +422,4 @@ For a trivial project, make just one task"""
     # save message history
     save_message_history(conv_id, messages)
 
-    # get message content
-    response_message = response["choices"][0]["message"]["content"] # type: ignore
-
-    # if response includes content, print it out
-    if print_message and response_message != None:
-        print("\n## ChatGPT Responded ##\n```\n")
-        print(response_message)
-        print("\n```\n")
-
     return messages
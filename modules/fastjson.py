@@ -0,0 +1,19 @@
+import json
+
+# use orjson if it is installed, otherwise fall back to json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(data, sort_keys=False):
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS if sort_keys else 0
+        return orjson.dumps(data, option=option).decode()
+
+    return json.dumps(data, separators=(",", ":"), sort_keys=sort_keys, ensure_ascii=False)
@@ -1,6 +1,5 @@
 import subprocess
 import openai
-import json
 import copy
 import time
 import re
@@ -8,6 +7,7 @@ import re
 from modules.helpers import codedir, reset_code_folder
 from modules.platform import join_cmd
 from modules import cmd_args
+from modules import fastjson
 from modules import chatgpt
 from modules import tokens
 
@@ -80,7 +80,7 @@ def get_commit_message(messages, model, temp):
         message = response["choices"][0]["message"]
         git_log.append(message)
 
-        answer = json.loads(message["function_call"]["arguments"]) # type: ignore
+        answer = fastjson.loads(message["function_call"]["arguments"]) # type: ignore
         commit_message = answer["commit_message"]
 
         request_tokens = response["usage"]["total_tokens"] # type: ignore
@@ -1,4 +1,5 @@
 import subprocess
+import functools
 import signal
 import copy
 import time
@@ -841,10 +842,17 @@ definitions = [
 ]
 
 def get_definitions(model):
-    global definitions
     global tasklist_skipped
 
-    func_definitions = copy.deepcopy(definitions)
+    return get_cached_definitions(model, tasklist_skipped)
+
+# definitions only depend on the model and whether
+# the task list was skipped, so filter them only once
+@functools.lru_cache(maxsize=16)
+def get_cached_definitions(model, tasklist_skipped):
+    global definitions
+
+    func_definitions = list(definitions)
 
     # gpt-3.5 is not responsible enough for these functions
     gpt3_disallow = [
@@ -865,7 +873,7 @@ def get_definitions(model):
     if "no-cmd" in cmd_args.args:
         func_definitions = [definition for definition in func_definitions if definition["name"] != "run_cmd"]
 
-    return func_definitions
+    return tuple(func_definitions)
 
 def function_available(function, model):
     definitions = get_definitions(model)
@@ -1,34 +1,19 @@
+import asyncio
 import openai
-import json
 import sys
 import os
 
 from modules.helpers import yesno
 from modules import checklist
+from modules import fastjson
 from modules import cmd_args
 from modules import tokens
 from modules import paths
 
-def detect_slug(prompt, model, temp):
-    slugs = {}
-
-    for filename in os.scandir(paths.relative("prompts")):
-        if os.path.isdir(filename):
-            description_file = os.path.join(filename, "description")
-            if os.path.isfile(description_file):
-                with open(description_file) as f:
-                    description = f.read()
-            else:
-                description = ""
-
-            slugs[os.path.basename(filename)] = description
-
-    slugs["ambiguous"] = "For projects whose type can not be accurately detected based on the given prompt"
-
-    messages = [
-        {
-            "role": "system",
-            "content": f"""
+# static part of the slug detection system message.
+# dynamic content goes to the user message so that the
+# system message stays identical for prompt caching
+SLUG_SYSTEM_MESSAGE = """
 You are an AI bot that can autonomously create projects from the users's description.
 You have available to you some instructions for different kinds of projects.
 You will search through the instructions and respond with the slug of an
@@ -36,8 +21,135 @@ instruction that fits the users's description. If the proper instruction
 can not be determined accurately from the user's prompt, return "default"
 
 List of instruction slugs and their descriptions:\n
-{json.dumps(slugs, indent=4)}
 """
+
+BATCH_USER_MESSAGE = "Detect the slug for each of the following prompts. Return the slugs in the same order.\n\n{prompts}"
+
+slug_properties = {
+    "slug": {
+        "type": "string",
+        "description": "The category slug",
+    },
+    "certainty": {
+        "type": "number",
+        "description": "The certainty (0-100) that this prompt belongs to this category"
+    }
+}
+
+set_slug_call = {
+    "name": "set_slug",
+    "arguments": "slug"
+}
+
+set_slug_func = {
+    "name": "set_slug",
+    "description": "Set the category slug. Default if uncertain.",
+    "parameters": {
+        "type": "object",
+        "properties": slug_properties,
+        "required": ["slug", "certainty"],
+    }
+}
+
+set_slugs_call = {
+    "name": "set_slugs",
+    "arguments": "slugs"
+}
+
+set_slugs_func = {
+    "name": "set_slugs",
+    "description": "Set the category slug of each prompt, in the same order as given. Default if uncertain.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "slugs": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": slug_properties,
+                    "required": ["slug", "certainty"],
+                }
+            }
+        },
+        "required": ["slugs"],
+    }
+}
+
+prompts = None
+prompts_mtime = 0.0
+slugs = None
+slug_system_message = None
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def load_prompt(path):
+    checklist_path = os.path.join(path, "checklist.json")
+
+    return {
+        "description": read_file(os.path.join(path, "description")) or "",
+        "system_message": read_file(os.path.join(path, "system_message")),
+        "checklist": checklist_path if os.path.exists(checklist_path) else None,
+    }
+
+def get_prompts():
+    global prompts
+    global prompts_mtime
+    global slugs
+    global slug_system_message
+
+    prompts_dir = paths.relative("prompts")
+    mtime = os.stat(prompts_dir).st_mtime
+
+    # rescan only if prompts were added or removed
+    if prompts is not None and mtime == prompts_mtime:
+        return prompts
+
+    prompts = {}
+
+    with os.scandir(prompts_dir) as it:
+        entries = [entry for entry in it if entry.is_dir()]
+
+    # scan in sorted order so that the slug list is deterministic
+    for entry in sorted(entries, key=lambda e: e.name):
+        prompts[entry.name] = load_prompt(entry.path)
+
+    prompts_mtime = mtime
+    slugs = None
+    slug_system_message = None
+
+    return prompts
+
+def get_slugs():
+    global slugs
+
+    current_prompts = get_prompts()
+
+    if slugs is None:
+        slugs = {slug: data["description"] for slug, data in current_prompts.items()}
+        slugs["ambiguous"] = "For projects whose type can not be accurately detected based on the given prompt"
+
+    return slugs
+
+def get_slug_system_message():
+    global slug_system_message
+
+    current_slugs = get_slugs()
+
+    if slug_system_message is None:
+        slug_system_message = SLUG_SYSTEM_MESSAGE + fastjson.dumps(current_slugs, sort_keys=True) + "\n"
+
+    return slug_system_message
+
+async def adetect_slug(prompt, model, temp):
+    messages = [
+        {
+            "role": "system",
+            "content": get_slug_system_message()
         },
         {
             "role": "user",
@@ -47,42 +159,43 @@ List of instruction slugs and their descriptions:\n
 
     print("GPT-API:  Detecting system message...")
 
-    response = openai.ChatCompletion.create(
+    response = await openai.ChatCompletion.acreate(
         model=model,
         messages=messages,
         temperature=temp,
         request_timeout=10,
-        function_call={
-            "name": "set_slug",
-            "arguments": "slug"
-        },
-        functions=[
-            {
-                "name": "set_slug",
-                "description": "Set the category slug. Default if uncertain.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "slug": {
-                            "type": "string",
-                            "description": "The category slug",
-                        },
-                        "certainty": {
-                            "type": "number",
-                            "description": "The certainty (0-100) that this prompt belongs to this category"
-                        }
-                    },
-                    "required": ["slug", "certainty"],
-                }
-            }
-        ]
+        function_call=set_slug_call,
+        functions=[set_slug_func],
     )
 
     tokens.add(response, model)
 
-    slug = json.loads(response["choices"][0]["message"]["function_call"]["arguments"]) # type: ignore
-    certainty = slug["certainty"]
-    slug = slug["slug"]
+    return fastjson.loads(response["choices"][0]["message"]["function_call"]["arguments"]) # type: ignore
+
+def detect_slug(prompt, model, temp, detected=None, fallback_model=None):
+    slugs = get_slugs()
+
+    # use concurrently detected slug (or its error) if available
+    if detected is None:
+        try:
+            detected = asyncio.run(adetect_slug(prompt, model, temp))
+        except SystemExit:
+            raise
+        except Exception as e:
+            detected = e
+
+    failed = isinstance(detected, Exception)
+
+    # ask the main model if the routing model failed or is uncertain
+    if fallback_model not in [None, model] and (failed or detected["certainty"] < 90):
+        if failed:
+            print(f"ERROR:    Unable to detect system message with '{model}', trying '{fallback_model}'")
+        detected = asyncio.run(adetect_slug(prompt, fallback_model, temp))
+    elif failed:
+        raise detected
+
+    certainty = detected["certainty"]
+    slug = detected["slug"]
 
     if certainty < 90:
         slug = "default"
@@ -100,10 +213,61 @@ List of instruction slugs and their descriptions:\n
 
     return slug
 
-def get_data(prompt, model, temp, slug=None):
+# not used by gpt-autopilot itself, for detecting
+# system messages of many prompts from other scripts
+def detect_slug_batch(prompts, model, temp):
+    slugs = get_slugs()
+
+    # detect slugs of multiple prompts with a single request
+    messages = [
+        {
+            "role": "system",
+            "content": get_slug_system_message()
+        },
+        {
+            "role": "user",
+            "content": BATCH_USER_MESSAGE.format(prompts=fastjson.dumps(prompts))
+        }
+    ]
+
+    print("GPT-API:  Detecting system messages...")
+
+    response = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        temperature=temp,
+        request_timeout=10 * len(prompts),
+        function_call=set_slugs_call,
+        functions=[set_slugs_func],
+    )
+
+    tokens.add(response, model)
+
+    detected = fastjson.loads(response["choices"][0]["message"]["function_call"]["arguments"])["slugs"] # type: ignore
+
+    if len(detected) != len(prompts):
+        print("ERROR:    Batch response doesn't match prompts, using default system message")
+        return ["default"] * len(prompts)
+
+    result = []
+    for item in detected:
+        slug = item["slug"]
+
+        if item["certainty"] < 90 or slug == "ambiguous":
+            slug = "default"
+
+        if slug not in slugs:
+            print(f"ERROR:    GPT detected system message '{slug}' that doesn't exist")
+            slug = "default"
+
+        result.append(slug)
+
+    return result
+
+def get_data(prompt, model, temp, slug=None, detected=None, fallback_model=None):
     if slug is None:
         try:
-            slug = detect_slug(prompt, model, temp)
+            slug = detect_slug(prompt, model, temp, detected, fallback_model)
         except SystemExit:
             raise
         except:
@@ -118,21 +282,24 @@ def get_data(prompt, model, temp, slug=None):
         "slug": slug
     }
 
-    checklist_path = paths.relative("prompts", slug, "checklist.json")
-    system_message_path = paths.relative("prompts", slug, "system_message")
+    prompt_files = get_prompts().get(slug)
 
-    if os.path.exists(checklist_path):
-        data["checklist"] = checklist_path
+    # load prompts outside of the cache from disk
+    if prompt_files is None:
+        prompt_files = load_prompt(paths.relative("prompts", slug))
 
-    if os.path.exists(system_message_path):
-        data["system_message"] = system_message_path
+    if prompt_files["checklist"] is not None:
+        data["checklist"] = prompt_files["checklist"]
+
+    if prompt_files["system_message"] is not None:
+        data["system_message"] = prompt_files["system_message"]
     else:
         print(f"ERROR:    System message '{slug}' not found")
         sys.exit(1)
 
     return data
 
-def select_system_message(prompt, model, temp):
+def select_system_message(prompt, model, temp, detected=None, fallback_model=None):
     if "system" in cmd_args.args:
         slug = cmd_args.args["system"]
     elif "use-system" in cmd_args.args:
@@ -144,7 +311,7 @@ def select_system_message(prompt, model, temp):
             slug = "default"
         print()
 
-    prompt_data = get_data(prompt, model, temp, slug)
+    prompt_data = get_data(prompt, model, temp, slug, detected, fallback_model)
 
     slug = prompt_data["slug"]
     print(f"SYSTEM:   Using system message '{slug}'")
@@ -156,7 +323,4 @@ def select_system_message(prompt, model, temp):
     else:
         print()
 
-    with open(str(prompt_data["system_message"]), "r") as f:
-        system_message = f.read()
-
-    return system_message
+    return prompt_data["system_message"]
@@ -10,6 +10,7 @@ token_usage = {
     "input": 0.0,
     "output": 0.0,
     "total": 0.0,
+    "price": 0.0,
 }
 
 # global prev token usage
@@ -29,6 +30,9 @@ def get_token_price(model, direction):
     elif model == "gpt-3.5-turbo-16k-0613":
         token_price_input = 0.003 / 1000
         token_price_output = 0.004 / 1000
+    elif model == "gpt-4o-mini":
+        token_price_input = 0.00015 / 1000
+        token_price_output = 0.0006 / 1000
     else:
         token_price_input = 0.0
         token_price_output = 0.0
@@ -38,7 +42,7 @@ def get_token_price(model, direction):
     else:
         return token_price_output
 
-def add(response, model):
+def add(response, model, price_factor=1.0):
     global token_usage
 
     # get token counts
@@ -65,8 +69,11 @@ def add(response, model):
             "price": 0.0,
         }
 
-    # calculate session price
-    total_price = get_token_cost(model, prompt_tokens, completion_tokens)
+    # calculate request price with its own model and discount
+    total_price = get_token_cost(model, prompt_tokens, completion_tokens) * price_factor
+
+    # increment session price
+    token_usage["price"] += total_price
 
     # increment total token usage
     total_token_usage["input"] += prompt_tokens
@@ -89,6 +96,11 @@ def add(response, model):
 def get_token_cost(model, input_tokens=None, output_tokens=None):
     global token_usage
 
+    # session price is tracked per request, as requests
+    # may use different models and discounts
+    if input_tokens is None and output_tokens is None:
+        return token_usage["price"]
+
     if input_tokens is None:
         input_tokens = int(token_usage["input"])
 